@@ -72,8 +72,7 @@ def geojson_centers(df):
 
     """
     centers = []
-    for i in range(0, len(df)):
-        row = df.iloc[i]
+    for row in df.itertuples(index=False):
         poly = row.polygon
 
         if poly == 'MultiPolygon':
@@ -110,19 +109,20 @@ def geojson_predict(df):
     ------------
     Adds two columns 'pred_gen' and 'pred_stor' to the input dataframe,
     containing the predicted energy generation and storage types for each
-    feature, based on ela.get_predicted_type() for the latitude and longitude
-    in the 'centers' column.
+    feature. Predictions are made in one batch with ela.gen_clf and
+    ela.stor_clf (the classifiers behind ela.get_predicted_type()) for the
+    latitude and longitude in the 'centers' column.
 
     """
 
-    gens = []
-    stors = []
-    for index, row in df.iterrows():
-        latlon = row.centers
-        gens.append(ela.get_predicted_type(latlon, 'gen'))
-        stors.append(ela.get_predicted_type(latlon, 'stor'))
-    df['pred_gen'] = gens
-    df['pred_stor'] = stors
+    if len(df) == 0:
+        df['pred_gen'] = []
+        df['pred_stor'] = []
+        return
+
+    centers = np.asarray(df['centers'].tolist(), dtype=np.float64)
+    df['pred_gen'] = ela.gen_clf.predict(centers)
+    df['pred_stor'] = ela.stor_clf.predict(centers)
 
 
 def pred_gen_to_colors(df):
@@ -143,7 +143,7 @@ def pred_gen_to_colors(df):
             the predicted energy generation type for each feature
 
     """
-    return {df.iloc[i].id: type_colors[df.iloc[i].pred_gen] for i in df.index}
+    return {fid: type_colors[tp] for fid, tp in zip(df.id, df.pred_gen)}
 
 
 def pred_stor_to_colors(df):
@@ -164,7 +164,7 @@ def pred_stor_to_colors(df):
             the predicted energy storage type for each feature
 
     """
-    return {df.iloc[i].id: type_colors[df.iloc[i].pred_stor] for i in df.index}
+    return {fid: type_colors[tp] for fid, tp in zip(df.id, df.pred_stor)}
 
 
 def prediction_map(geoj, gen_or_stor):
@@ -235,14 +235,14 @@ def facility_map(state, gen_or_stor):
 
     f = folium.map.FeatureGroup()
     if gen_or_stor == 'gen':
-        for index, row in state_df.iterrows():
+        for row in state_df.itertuples(index=False):
             tp = row.type
             f.add_child(folium.CircleMarker([row.lat, row.lon],
                                             radius=5, weight=1,
                                             fill_color=type_colors[tp],
                                             fill_opacity=1))
     elif gen_or_stor == 'stor':
-        for index, row in state_df.iterrows():
+        for row in state_df.itertuples(index=False):
             tp = row.type
             f.add_child(folium.RegularPolygonMarker([row.lat, row.lon],
                                                     number_of_sides=3,
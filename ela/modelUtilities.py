@@ -4,8 +4,9 @@ of the main core of ELA and do not have comprehensive testing and error
 handling."""
 
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
-from sklearn.neighbors import KNeighborsClassifier
+from sklearn.neighbors import BallTree, KNeighborsClassifier
 import folium
 
 import ela
@@ -13,6 +14,82 @@ import ela
 gen = ela.gen_data
 stor = ela.stor_data
 
+# Leaf size for every neighbor-search tree built in this module.
+leaf_size = 40
+
+# Ball trees for gen and stor, keyed by 'gen' or 'stor' and built on first
+# use by fit_tree. Emptied by clear_tree_cache.
+_fitted_trees = {}
+
+
+def knn_classifier(k, weights):
+    """
+    Create an unfitted KNN classifier for latitude-longitude data.
+
+    Parameters
+    ----------
+    k : int
+        Number of nearest-neighbors to consider in KNN model.
+    weights : string
+        Type of weighting to use for KNN model ('distance' or 'uniform')
+
+    Returns
+    -------
+    KNeighborsClassifier
+        Classifier using a ball tree with the haversine (great-circle)
+        metric, and querying on all available cores. Fit and predict it
+        with coordinates from latlon_array, which are in radians.
+
+    """
+
+    return KNeighborsClassifier(n_neighbors=k, weights=weights,
+                                algorithm='ball_tree', metric='haversine',
+                                leaf_size=leaf_size, n_jobs=-1)
+
+
+def latlon_array(df):
+    """
+    Extract facility coordinates as an array for fitting or querying KNN.
+
+    Parameters
+    ----------
+    df : Pandas dataframe
+        Must contain 'lat' and 'lon' columns.
+
+    Returns
+    -------
+    array of floats, shape (len(df), 2)
+        C-contiguous latitude and longitude values for each row, in radians
+        as required by the haversine metric.
+
+    """
+
+    return np.radians(np.ascontiguousarray(df[['lat', 'lon']].values,
+                                           dtype=np.float64))
+
+
+def encode_types(df):
+    """
+    Integer-encode the energy types of facilities for fitting KNN.
+
+    Parameters
+    ----------
+    df : Pandas dataframe
+        Must contain a 'type' column.
+
+    Returns
+    -------
+    (codes, classes) : tuple of arrays
+        codes : int16 index into classes of each row's energy type.
+        classes : sorted unique energy types, so classes[codes] recovers the
+            'type' column. Sorting keeps ties broken toward the same type
+            as when fitting on the strings directly.
+
+    """
+
+    codes, classes = pd.factorize(df['type'], sort=True)
+    return codes.astype(np.int16), np.asarray(classes)
+
 
 def count_types(df):
     """
@@ -25,8 +102,8 @@ def count_types(df):
 
     """
 
-    for tp in df.type.unique():
-        print(tp, len(df[df.type == tp]))
+    for tp, count in df.type.value_counts().items():
+        print(tp, count)
 
 
 def predict_types(k, weights, train_df, test_df):
@@ -48,6 +125,9 @@ def predict_types(k, weights, train_df, test_df):
         X coordinates are the 'lat' and 'lon' columns.
         Y values (predicted types) are the 'type' column.
 
+    Both dataframes must own their data rather than be a slice of another
+    dataframe (use .copy() on a slice), since a column is added to each.
+
 
     Side Effects
     ------------
@@ -57,12 +137,12 @@ def predict_types(k, weights, train_df, test_df):
 
     """
 
-    clf = KNeighborsClassifier(n_neighbors=k, weights=weights)
-    clf.fit(train_df[['lat', 'lon']], np.ravel(train_df.type))
-    train_df.is_copy = False
-    test_df.is_copy = False
-    train_df['pred'] = clf.predict(train_df[['lat', 'lon']])
-    test_df['pred'] = clf.predict(test_df[['lat', 'lon']])
+    clf = knn_classifier(k, weights)
+    x_train = latlon_array(train_df)
+    y_train, classes = encode_types(train_df)
+    clf.fit(x_train, y_train)
+    train_df.loc[:, 'pred'] = classes[clf.predict(x_train)]
+    test_df.loc[:, 'pred'] = classes[clf.predict(latlon_array(test_df))]
 
 
 def count_pred_types(df):
@@ -77,8 +157,8 @@ def count_pred_types(df):
 
     """
 
-    for tp in df.pred.unique():
-        print(tp, len(df[df.pred == tp]))
+    for tp, count in df.pred.value_counts().items():
+        print(tp, count)
 
 
 def try_k(k, weights, train_df, test_df):
@@ -108,18 +188,163 @@ def try_k(k, weights, train_df, test_df):
 
     """
 
-    clf = KNeighborsClassifier(n_neighbors=k, weights=weights)
-    x_train = train_df[['lat', 'lon']]
-    y_train = np.ravel(train_df.type)
+    x_train = latlon_array(train_df)
+    y_train, classes = encode_types(train_df)
+    clf = knn_classifier(k, weights)
     clf.fit(x_train, y_train)
-    x_test = test_df[['lat', 'lon']]
+    x_test = latlon_array(test_df)
     y_test = np.ravel(test_df.type)
 
-    train_error = 1 - clf.score(x_train, y_train)
-    test_error = 1 - clf.score(x_test, y_test)
+    train_error = np.mean(clf.predict(x_train) != y_train)
+    test_error = np.mean(classes[clf.predict(x_test)] != y_test)
     return train_error, test_error
 
 
+def knn_vote(labels, dist, weights, n_classes):
+    """
+    Predict classes by a (weighted) vote among precomputed nearest-neighbors.
+
+    Parameters
+    ----------
+    labels : array of ints, shape (n_points, k)
+        Class index of each neighbor of each point, ordered nearest first.
+    dist : array of floats, shape (n_points, k)
+        Distance from each point to each of its neighbors.
+    weights : string
+        Type of weighting to use for KNN model ('distance' or 'uniform')
+    n_classes : int
+        Number of classes; all labels must be less than this.
+
+    Returns
+    -------
+    array of ints, shape (n_points,)
+        Class index that wins the vote for each point. Ties go to the lowest
+        class index, as in sklearn's KNeighborsClassifier.
+
+    Raises
+    ------
+    ValueError if weights is not either 'uniform' or 'distance'.
+
+    """
+
+    if weights == 'uniform':
+        w = np.ones(dist.shape)
+    elif weights == 'distance':
+        # Like sklearn, neighbors at zero distance outvote all others.
+        with np.errstate(divide='ignore'):
+            w = 1. / dist
+        inf_mask = np.isinf(w)
+        inf_rows = inf_mask.any(axis=1)
+        w[inf_rows] = inf_mask[inf_rows]
+    else:
+        raise ValueError("Enter either 'uniform' or 'distance'.")
+
+    # Tally every (point, class) vote in one bincount over flat bin indices.
+    n_points = len(labels)
+    bins = np.arange(n_points)[:, np.newaxis] * n_classes + labels
+    scores = np.bincount(bins.ravel(), weights=w.ravel(),
+                         minlength=n_points * n_classes)
+    return scores.reshape(n_points, n_classes).argmax(axis=1)
+
+
+def fit_tree(train_df):
+    """
+    Build a haversine ball tree over facility locations for KNN queries.
+
+    Parameters
+    ----------
+    train_df : Pandas dataframe
+        Data to use for training the KNN model.
+        X coordinates are the 'lat' and 'lon' columns.
+        Y values (predicted types) are the 'type' column.
+
+    Returns
+    -------
+    (tree, codes, classes) : tuple
+        tree : BallTree over latlon_array(train_df).
+        codes, classes : output of encode_types(train_df).
+
+    Notes
+    -----
+    The result for the module data (ela.gen_data and ela.stor_data) is
+    cached, since it does not depend on K or the weighting type. Call
+    clear_tree_cache after modifying those dataframes in place.
+
+    """
+
+    if train_df is gen:
+        key = 'gen'
+    elif train_df is stor:
+        key = 'stor'
+    else:
+        key = None
+    if key in _fitted_trees:
+        return _fitted_trees[key]
+
+    codes, classes = encode_types(train_df)
+    tree = BallTree(latlon_array(train_df), leaf_size=leaf_size,
+                    metric='haversine')
+    if key is not None:
+        _fitted_trees[key] = (tree, codes, classes)
+    return tree, codes, classes
+
+
+def clear_tree_cache():
+    """
+    Discard the cached fit_tree results for ela.gen_data and ela.stor_data.
+
+    Side Effects
+    ------------
+    The next call to fit_tree (and so to knn_predict, geojson_predict_k or
+    prediction_map_k) for either dataframe rebuilds its tree, picking up
+    any in-place changes to the data.
+
+    """
+
+    _fitted_trees.clear()
+
+
+def knn_predict(train_df, x, k, weights):
+    """
+    Predict energy types for many locations at once with a ball tree KNN.
+
+    Parameters
+    ----------
+    train_df : Pandas dataframe
+        Data to use for training the KNN model.
+        X coordinates are the 'lat' and 'lon' columns.
+        Y values (predicted types) are the 'type' column.
+    x : array of floats, shape (n_points, 2)
+        Latitude and longitude values of the locations to predict, in
+        radians.
+    k : int
+        Number of nearest-neighbors to consider in KNN model.
+    weights : string
+        Type of weighting to use for KNN model ('distance' or 'uniform')
+
+    Returns
+    -------
+    array of strings, shape (n_points,)
+        Predicted energy type for each location.
+
+    Notes
+    -----
+    The query points are searched with a dual-tree traversal, which shares
+    work between nearby queries when many locations are predicted together.
+    When several training points are equally distant from a location
+    (e.g. facilities of different types at the same site), this search can
+    select different neighbors than KNeighborsClassifier.predict, so a few
+    predictions can differ from it.
+
+    """
+
+    tree, y_train, classes = fit_tree(train_df)
+    if len(x) == 0:
+        return classes[:0]
+    dist, ind = tree.query(x, k=k, dualtree=True)
+    return classes[knn_vote(y_train[ind], dist, weights, len(classes))]
+
+
 def try_k_range(k_list, weights, train_df, test_df):
     """
     Evaluate KNN model and return training and testing error for different K.
@@ -146,17 +371,49 @@ def try_k_range(k_list, weights, train_df, test_df):
         Second column: floats, training error rate for KNN with each K.
         Third column: floats, testing error rate for KNN with each K.
 
+    Raises
+    ------
+    ValueError if any K-value is less than 1.
+
+    Notes
+    -----
+    Neighbors for every K are taken from a single query for the largest K.
+    When several training points are equally distant (e.g. facilities at
+    the same location), this can select different neighbors than a fresh
+    query with the smaller K, so error rates can differ slightly from
+    try_k for the same K.
+
     """
-    errors = np.zeros((len(k_list), 3))
-    for i in range(len(k_list)):
-        k_errors = try_k(k_list[i], weights, train_df, test_df)
-        errors[i, 0] = k_list[i]
-        errors[i, 1] = k_errors[0]
-        errors[i, 2] = k_errors[1]
-    return errors
+    if len(k_list) == 0:
+        return np.zeros((0, 3))
+    if min(k_list) < 1:
+        raise ValueError("K-values must be at least 1.")
 
+    tree, y_train, classes = fit_tree(train_df)
+    y_test = np.ravel(test_df.type)
 
-def plot_knn_error(k_max, weights, train_df, test_df):
+    # Neighbors for smaller K are a prefix of the neighbors for the largest
+    # K, so query the tree once and slice for every K-value.
+    k_max = max(k_list)
+    x_train = np.asarray(tree.data)
+    train_dist, train_ind = tree.query(x_train, k=k_max)
+    test_dist, test_ind = tree.query(latlon_array(test_df), k=k_max)
+    train_labels = y_train[train_ind]
+    test_labels = y_train[test_ind]
+
+    train_error = np.empty(len(k_list))
+    test_error = np.empty(len(k_list))
+    for i, k in enumerate(k_list):
+        train_pred = knn_vote(train_labels[:, :k], train_dist[:, :k],
+                              weights, len(classes))
+        test_pred = knn_vote(test_labels[:, :k], test_dist[:, :k],
+                             weights, len(classes))
+        train_error[i] = np.mean(train_pred != y_train)
+        test_error[i] = np.mean(classes[test_pred] != y_test)
+    return np.column_stack([k_list, train_error, test_error])
+
+
+def plot_knn_error(k_max, weights, train_df, test_df, plot=True):
     """
     Plot training and testing error rate vs K.
 
@@ -174,10 +431,19 @@ def plot_knn_error(k_max, weights, train_df, test_df):
         Data to use for test the KNN model.
         X coordinates are the 'lat' and 'lon' columns.
         Y values (predicted types) are the 'type' column.
+    plot : bool, optional
+        If False, skip creating the figure and only return the error rates.
 
+    Returns
+    -------
+    result : array
+        Output of try_k_range for the K-values used.
 
     """
     result = try_k_range(list(range(1, k_max)), weights, train_df, test_df)
+    if not plot:
+        return result
+
     plt.figure(figsize=(4, 4))
     k = result[:, 0]
     train_error = result[:, 1]
@@ -189,6 +455,7 @@ def plot_knn_error(k_max, weights, train_df, test_df):
     plt.ylim(0, 1)
     plt.xlim(0, k_max + 1)
     plt.legend()
+    return result
 
 
 def geojson_predict_k(geo_df, gen_train, stor_train, k, weights):
@@ -228,21 +495,36 @@ def geojson_predict_k(geo_df, gen_train, stor_train, k, weights):
 
     """
 
-    gen_clf = KNeighborsClassifier(n_neighbors=k, weights=weights)
-    gen_clf.fit(gen_train[['lat', 'lon']], np.ravel(gen_train.type))
-    stor_clf = KNeighborsClassifier(n_neighbors=k, weights=weights)
-    stor_clf.fit(stor_train[['lat', 'lon']], np.ravel(stor_train.type))
-    gens = []
-    stors = []
-    for index, row in geo_df.iterrows():
-        latlon = np.asarray(row.centers).reshape(1, 2)
-        gens.append(gen_clf.predict(latlon)[0])
-        stors.append(stor_clf.predict(latlon)[0])
-    geo_df['pred_gen'] = gens
-    geo_df['pred_stor'] = stors
+    centers = np.asarray(geo_df['centers'].tolist(), dtype=np.float64)
+    centers = np.radians(centers.reshape(-1, 2))
+    geo_df['pred_gen'] = knn_predict(gen_train, centers, k, weights)
+    geo_df['pred_stor'] = knn_predict(stor_train, centers, k, weights)
 
 
-def prediction_map_k(geoj, k, weights, gen_or_stor):
+def prepare_geo_df(geoj):
+    """
+    Build the dataframe of geographic features and centers used for mapping.
+
+    Parameters
+    ----------
+    geoj : GeoJSON object
+        Contains state or county boundaries
+
+    Returns
+    -------
+    Pandas dataframe
+        Output of ela.geojson_to_df, with the 'centers' column added by
+        ela.geojson_centers. This can be passed to prediction_map_k to avoid
+        re-processing the same GeoJSON for each K and weighting type.
+
+    """
+
+    geo_df = ela.geojson_to_df(geoj)
+    ela.geojson_centers(geo_df)
+    return geo_df
+
+
+def prediction_map_k(geoj, k, weights, gen_or_stor, geo_df=None):
     """
     Create a Folium map layer with features colored by predicted energy type,
     based on KNN with selected K and weighting type.
@@ -257,6 +539,9 @@ def prediction_map_k(geoj, k, weights, gen_or_stor):
         Type of weighting to use for KNN model ('distance' or 'uniform')
     gen_or_stor : string, either 'gen' or 'stor'
         Specify whether to map predicted generation or storage types.
+    geo_df : Pandas dataframe, optional
+        Output of prepare_geo_df for the input geoj. Computed from geoj if
+        not given. Its 'pred_gen' and 'pred_stor' columns are overwritten.
 
     Returns
     -------
@@ -271,12 +556,15 @@ def prediction_map_k(geoj, k, weights, gen_or_stor):
     Notes
     -----
     This is a variation on ela.mapping.prediction_map() which enables the KNN
-    weighting and K-value to be varied.
+    weighting and K-value to be varied. It also measures great-circle
+    (haversine) distance, while ela.gen_clf and ela.stor_clf used by
+    prediction_map() measure Euclidean distance in latitude-longitude units,
+    so the maps can differ even for K = 1 with distance weighting.
 
     """
 
-    geo_df = ela.geojson_to_df(geoj)
-    ela.geojson_centers(geo_df)
+    if geo_df is None:
+        geo_df = prepare_geo_df(geoj)
     geojson_predict_k(geo_df, ela.gen_data, ela.stor_data, k, weights)
 
     if gen_or_stor == 'gen':
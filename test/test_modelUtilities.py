@@ -0,0 +1,105 @@
+import numpy as np
+from sklearn.neighbors import KNeighborsClassifier
+
+import ela
+from ela import modelUtilities
+
+
+def test_knn_vote():
+    """
+    Test for voting among precomputed neighbors, including ties and
+    neighbors at zero distance.
+    """
+
+    labels = np.array([[1, 0, 0], [2, 1, 1], [1, 0, 2]])
+    dist = np.array([[1., 2., 2.], [0., 1., 1.], [1., 1., 1.]])
+    assert list(modelUtilities.knn_vote(labels, dist, 'uniform', 3)) == \
+        [0, 1, 0], "Uniform vote is not the most common neighbor type"
+    assert list(modelUtilities.knn_vote(labels, dist, 'distance', 3)) == \
+        [0, 2, 0], "Zero-distance neighbors do not win the distance vote"
+    # Tests for input
+    try:
+        modelUtilities.knn_vote(labels, dist, 'abc', 3)
+    except ValueError:
+        print("Incorrect weights")
+    return
+
+
+def test_knn_predict():
+    """
+    Test that batched KNN predictions match sklearn's KNeighborsClassifier
+    """
+
+    # Co-located facilities give equidistant neighbors, which the two
+    # searches may choose between differently, so train without them.
+    train_df = ela.stor_data.drop_duplicates(['lat', 'lon'])
+    x_train = modelUtilities.latlon_array(train_df)
+    x = modelUtilities.latlon_array(ela.gen_data)
+    for weights in ['uniform', 'distance']:
+        for k in [1, 3, 10]:
+            clf = KNeighborsClassifier(n_neighbors=k, weights=weights,
+                                       algorithm='ball_tree',
+                                       metric='haversine',
+                                       leaf_size=modelUtilities.leaf_size)
+            clf.fit(x_train, np.ravel(train_df.type))
+            pred = modelUtilities.knn_predict(train_df, x, k, weights)
+            assert np.array_equal(pred, clf.predict(x)), \
+                "Predictions differ from KNeighborsClassifier"
+    return
+
+
+def test_try_k_range():
+    """
+    Test that a K-value sweep matches fitting a KNN model for each K
+    """
+
+    # Without co-located facilities there are no distance ties, so slicing
+    # one query for the largest K gives the same neighbors as try_k.
+    stor = ela.stor_data.drop_duplicates(['lat', 'lon'])
+    train_df = stor.iloc[::2]
+    test_df = stor.iloc[1::2]
+    k_list = [1, 2, 5, 12]
+    for weights in ['uniform', 'distance']:
+        errors = modelUtilities.try_k_range(k_list, weights, train_df,
+                                            test_df)
+        assert errors.shape == (len(k_list), 3), \
+            "The shape of the error array is incorrect"
+        assert list(errors[:, 0]) == k_list, \
+            "The K column does not match the input K-values"
+        for i in range(len(k_list)):
+            assert np.allclose(errors[i, 1:], modelUtilities.try_k(
+                k_list[i], weights, train_df, test_df)), \
+                "Error rates do not match try_k"
+    assert modelUtilities.try_k_range([], 'uniform', train_df,
+                                      test_df).shape == (0, 3), \
+        "An empty K list does not give an empty error array"
+    # Tests for input
+    for k_list in [[0, 3], [-1, 3]]:
+        try:
+            modelUtilities.try_k_range(k_list, 'uniform', train_df, test_df)
+            assert False, "K-values less than 1 were accepted"
+        except ValueError:
+            print("Incorrect K-value")
+    return
+
+
+def test_fit_tree_cache():
+    """
+    Test that ball trees are cached only for the module data, and rebuilt
+    after clearing the cache
+    """
+
+    tree = modelUtilities.fit_tree(ela.stor_data)[0]
+    assert modelUtilities.fit_tree(ela.stor_data)[0] is tree, \
+        "The tree for the storage data is not cached"
+    modelUtilities.clear_tree_cache()
+    assert modelUtilities.fit_tree(ela.stor_data)[0] is not tree, \
+        "The tree is not rebuilt after clearing the cache"
+    stor_copy = ela.stor_data.copy()
+    assert modelUtilities.fit_tree(stor_copy)[0] is not \
+        modelUtilities.fit_tree(stor_copy)[0], \
+        "A tree for a dataframe other than the module data is cached"
+    assert modelUtilities.fit_tree(ela.stor_data)[0] is not \
+        modelUtilities.fit_tree(stor_copy)[0], \
+        "A copy of the storage data shares the cached tree"
+    return